@@ -1,11 +1,18 @@
 import base64
+import contextlib
+import decimal
+import functools
+import io
+import itertools
 import logging
+import types
 
 from redash.query_runner import (
     BaseSQLQueryRunner,
     register,
     TYPE_STRING,
     TYPE_BOOLEAN,
+    TYPE_DATE,
     TYPE_DATETIME,
     TYPE_INTEGER,
     TYPE_FLOAT,
@@ -16,6 +23,8 @@ logger = logging.getLogger(__name__)
 
 try:
     import snowflake.connector
+    from snowflake.connector.constants import FIELD_ID_TO_NAME
+    from snowflake.connector.errors import NotSupportedError, ProgrammingError
     from cryptography.hazmat.backends import default_backend
     from cryptography.hazmat.primitives import serialization
     import os
@@ -24,22 +33,142 @@ try:
 except ImportError:
     enabled = False
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 
-TYPES_MAP = {
+_TYPES = {
     "TEXT": TYPE_STRING,
     "BOOLEAN": TYPE_BOOLEAN,
-    "DATE": TYPE_DATETIME,
+    "DATE": TYPE_DATE,
     "TIMESTAMP": TYPE_DATETIME,
     "TIMESTAMP_LTZ": TYPE_DATETIME,
     "TIMESTAMP_TZ": TYPE_DATETIME,
     "TIMESTAMP_NTZ": TYPE_DATETIME,
-    "NUMBER": TYPE_FLOAT,
-    "FLOAT": TYPE_FLOAT,
+    "FIXED": TYPE_INTEGER,
     "REAL": TYPE_FLOAT,
-    "DOUBLE": TYPE_FLOAT,
-    "INT": TYPE_INTEGER,
-    "INTEGER": TYPE_INTEGER,
 }
+# keyed by the type names in the connector's FIELD_ID_TO_NAME; use
+# _column_type to map a cursor.description entry
+TYPES_MAP = types.MappingProxyType(_TYPES)
+# bound to the underlying dict so lookups skip the proxy layer
+_TYPE_OF = _TYPES.get
+
+
+def _column_type(type_code, scale):
+    type_name = FIELD_ID_TO_NAME.get(type_code)
+    if type_name == "FIXED" and scale:
+        # NUMBER(p, s) with s > 0 holds decimals
+        return TYPE_FLOAT
+    return _TYPE_OF(type_name, TYPE_STRING)
+
+# rows fetched (and encoded) per fetchmany call for non-Arrow results
+FETCH_SIZE = 10000
+CLIENT_PREFETCH_THREADS = 4
+
+
+def _json_default(o):
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    return str(o)
+
+
+def _json_dumps(data):
+    """Serialize to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default)
+    return json_dumps(data, default=str).encode("utf-8")
+
+
+def _decimal_to_float(value):
+    return None if value is None else float(value)
+
+
+def _binary_to_hex(value):
+    return None if value is None else value.hex()
+
+
+# orjson only encodes integers that fit in 64 bits
+_INT_MIN = -(2 ** 63)
+_INT_MAX = 2 ** 64 - 1
+
+
+def _wide_int(value):
+    if value is None:
+        return None
+    value = int(value)
+    return value if _INT_MIN <= value <= _INT_MAX else float(value)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoder_for(type_code, precision, scale):
+    """Return the converter for values orjson can't encode natively, or None."""
+    type_name = FIELD_ID_TO_NAME.get(type_code)
+    if type_name == "FIXED" and scale:
+        return _decimal_to_float
+    if type_name == "FIXED" and precision and precision > 18:
+        return _wide_int
+    if type_name == "BINARY":
+        return _binary_to_hex
+    return None
+
+
+def _column_to_pylist(column):
+    # With pandas installed, pyarrow turns timestamp[ns] values (Snowflake's
+    # default TIMESTAMP_*(9)) into pd.Timestamp, a datetime subclass orjson
+    # doesn't encode natively. datetime/time only hold microseconds anyway.
+    column_type = column.type
+    if pyarrow.types.is_timestamp(column_type) and column_type.unit == "ns":
+        column = column.cast(pyarrow.timestamp("us", tz=column_type.tz), safe=False)
+    elif pyarrow.types.is_time64(column_type) and column_type.unit == "ns":
+        column = column.cast(pyarrow.time64("us"), safe=False)
+    return column.to_pylist()
+
+
+def _fetch_batches(cursor):
+    """Yield the result set as lists of row tuples.
+
+    Arrow results are converted a whole column at a time; anything else
+    (e.g. SHOW commands, which always return JSON, or a connector without
+    pyarrow) is read with fetchmany.
+    """
+    try:
+        tables = cursor.fetch_arrow_batches()
+    except (NotSupportedError, ProgrammingError):
+        tables = None
+
+    if tables is not None:
+        for table in tables:
+            # positional, so duplicate column names survive like in fetchmany rows
+            yield list(zip(*(_column_to_pylist(column) for column in table.columns)))
+        return
+
+    while True:
+        batch = cursor.fetchmany(cursor.arraysize)
+        if not batch:
+            return
+        yield batch
+
+
+def _load_private_key_der(pem_b64, passphrase):
+    """Decode a base64 PEM private key into the DER/PKCS8 bytes the connector expects."""
+    private_key = serialization.load_pem_private_key(
+        base64.b64decode(pem_b64),
+        password=passphrase.encode() if passphrase else None,
+        backend=default_backend(),
+    )
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
 
 
 class SnowflakeKeyPairEnv(BaseSQLQueryRunner):
@@ -68,6 +197,10 @@ class SnowflakeKeyPairEnv(BaseSQLQueryRunner):
                 # only the NAME of the env var is stored in DB
                 "private_key_env_var": {"type": "string"},
                 "private_key_pwd": {"type": "string"},
+                # SELECTs are read as Arrow batches; this only sizes fetchmany()
+                # for results that can't be (SHOW commands, no pyarrow)
+                "fallback_fetch_size": {"type": "number", "default": FETCH_SIZE},
+                "client_prefetch_threads": {"type": "number", "default": CLIENT_PREFETCH_THREADS},
             },
             "order": [
                 "account",
@@ -78,6 +211,8 @@ class SnowflakeKeyPairEnv(BaseSQLQueryRunner):
                 "role",
                 "private_key_env_var",
                 "private_key_pwd",
+                "fallback_fetch_size",
+                "client_prefetch_threads",
             ],
             "required": ["account", "user", "warehouse", "database", "private_key_env_var"],
             "secret": ["private_key_env_var", "private_key_pwd"],
@@ -88,9 +223,6 @@ class SnowflakeKeyPairEnv(BaseSQLQueryRunner):
         return enabled
 
     def _get_connection(self):
-        logger.error("=== SNOWFLAKE CONNECTION ATTEMPT ===")
-        logger.error("Configuration: %s", self.configuration)
-        
         params = {
             "account": self.configuration.get("account"),
             "user": self.configuration.get("user"),
@@ -98,86 +230,143 @@ class SnowflakeKeyPairEnv(BaseSQLQueryRunner):
             "database": self.configuration.get("database"),
             "schema": self.configuration.get("schema"),
             "role": self.configuration.get("role"),
+            "client_prefetch_threads": int(
+                self.configuration.get("client_prefetch_threads") or CLIENT_PREFETCH_THREADS
+            ),
+            "session_parameters": {"PYTHON_CONNECTOR_QUERY_RESULT_FORMAT": "ARROW"},
         }
-        logger.error("Connection params: %s", params)
 
         env_var = self.configuration.get("private_key_env_var")
-        logger.error("Private key env var: %s", env_var)
-        
         if env_var:
             pem_b64 = os.environ.get(env_var)
             if not pem_b64:
                 logger.error("Environment variable %s not set!", env_var)
                 raise Exception(f"Environment variable {env_var} not set")
-            logger.error("Private key loaded: %d bytes", len(pem_b64))
-            
+
             try:
-                pkey_bytes = base64.b64decode(pem_b64)
-                passphrase = self.configuration.get("private_key_pwd")
-                private_key = serialization.load_pem_private_key(
-                    pkey_bytes,
-                    password=passphrase.encode() if passphrase else None,
-                    backend=default_backend(),
+                params["private_key"] = _load_private_key_der(
+                    pem_b64, self.configuration.get("private_key_pwd")
                 )
-                pkb = private_key.private_bytes(
-                    encoding=serialization.Encoding.DER,
-                    format=serialization.PrivateFormat.PKCS8,
-                    encryption_algorithm=serialization.NoEncryption(),
-                )
-                params["private_key"] = pkb
-                logger.error("Private key processed successfully")
             except Exception as e:
                 logger.error("Private key processing failed: %s", str(e))
                 raise
 
-        logger.error("Attempting Snowflake connection...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Snowflake connect with params: %s", list(params.keys()))
         try:
-            connection = snowflake.connector.connect(**params)
-            logger.error("Snowflake connection successful!")
-            return connection
+            return snowflake.connector.connect(**params)
         except Exception as e:
             logger.error("Snowflake connection failed: %s", str(e))
             raise
 
+    @contextlib.contextmanager
+    def _acquire_cursor(self, cursor_class=None):
+        """Yield ``(connection, cursor)``, closing both when the block exits."""
+        connection = self._get_connection()
+        try:
+            cursor = connection.cursor(cursor_class) if cursor_class else connection.cursor()
+            try:
+                yield connection, cursor
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
     def test_connection(self):
         """Test the connection by running a simple query"""
         try:
             logger.info("Testing Snowflake connection...")
-            connection = self._get_connection()
-            cursor = connection.cursor()
-            try:
+            with self._acquire_cursor() as (connection, cursor):
                 cursor.execute("SELECT 1")
                 result = cursor.fetchone()
-                logger.info("Snowflake connection test successful: %s", result)
-            finally:
-                cursor.close()
-                connection.close()
+            logger.info("Snowflake connection test successful: %s", result)
         except Exception as e:
             logger.error("Snowflake connection test failed: %s", str(e))
             raise e
 
+    def get_schema(self, get_stats=False):
+        database = self.configuration.get("database")
+        schema_name = self.configuration.get("schema")
+        if schema_name:
+            query = "SHOW COLUMNS IN SCHEMA {}.{}".format(database, schema_name)
+        else:
+            query = "SHOW COLUMNS IN DATABASE {}".format(database)
+
+        with self._acquire_cursor(snowflake.connector.DictCursor) as (connection, cursor):
+            cursor.execute(query)
+            rows = cursor.fetchall()
+
+        tables = {}
+        for row in rows:
+            if row["kind"] != "COLUMN":
+                continue
+            table_name = "{}.{}".format(row["schema_name"], row["table_name"])
+            if table_name not in tables:
+                tables[table_name] = {"name": table_name, "columns": []}
+            tables[table_name]["columns"].append(row["column_name"])
+        return list(tables.values())
+
     def run_query(self, query, user):
-        logger.info("Running Snowflake query: %s", query[:100] if len(query) > 100 else query)
-        connection = self._get_connection()
-        cursor = connection.cursor()
+        logger.info("Running Snowflake query: %s", query[:100])
         try:
-            cursor.execute(query)
-            columns = self.fetch_columns(
-                [(col[0], TYPES_MAP.get(col[1], TYPE_STRING)) for col in cursor.description]
-            )
-            rows = [dict(zip((c["name"] for c in columns), r)) for r in cursor]
-            data = {"columns": columns, "rows": rows}
+            with self._acquire_cursor() as (connection, cursor):
+                cursor.arraysize = int(self.configuration.get("fallback_fetch_size") or FETCH_SIZE)
+                cursor.execute(query)
+                type_of = _column_type
+                columns = self.fetch_columns(
+                    [(col[0], type_of(col[1], col[5])) for col in cursor.description]
+                )
+                json_data, row_count = self._serialize_results(cursor, columns)
             error = None
-            json_data = json_dumps(data, default=str)
-            logger.info("Snowflake query successful, returned %d rows", len(rows))
+            logger.info("Snowflake query successful, returned %d rows", row_count)
         except Exception as e:
             logger.exception("Snowflake query failed")
             error = str(e)
             json_data = None
-        finally:
-            cursor.close()
-            connection.close()
         return json_data, error
 
+    def _serialize_results(self, cursor, columns):
+        """Encode the result set batch by batch instead of materializing every row."""
+        # Redash expects each row as a {column name: value} mapping, so the
+        # dicts stay; they are built via map() so no Python frame runs per row.
+        # Rows come from a plain cursor rather than a DictCursor, which would
+        # collapse duplicate column names that fetch_columns has renamed.
+        names = tuple(c["name"] for c in columns)
+        # Decimal and binary cells are converted up front, column by column, so
+        # orjson never falls back to calling _json_default once per cell.
+        converters = [
+            (i, encoder)
+            for i, encoder in enumerate(_encoder_for(col[1], col[4], col[5]) for col in cursor.description)
+            if encoder is not None
+        ]
+
+        def convert(row):
+            row = list(row)
+            for i, encoder in converters:
+                row[i] = encoder(row[i])
+            return row
+
+        buf = io.BytesIO()
+        buf.write(b'{"columns":')
+        buf.write(_json_dumps(columns))
+        buf.write(b',"rows":[')
+        row_count = 0
+        for batch in _fetch_batches(cursor):
+            if not batch:
+                continue
+            if row_count:
+                buf.write(b",")
+            if converters:
+                batch = map(convert, batch)
+            rows = list(map(dict, map(zip, itertools.repeat(names), batch)))
+            # strip the enclosing brackets so batches join into one array; a
+            # memoryview slice avoids copying the encoded batch again
+            buf.write(memoryview(_json_dumps(rows))[1:-1])
+            row_count += len(rows)
+        buf.write(b"]}")
+        # Redash stores json_data as text, so this is the one place bytes become
+        # str; decoding the buffer view directly skips a getvalue() copy
+        return str(buf.getbuffer(), "utf-8"), row_count
+
 
 register(SnowflakeKeyPairEnv)